@@ -5,13 +5,22 @@ Optimized for minimal inode usage during processing
 """
 
 import argparse
+import gzip
 import logging
+import multiprocessing
 import os
+import posixpath
+import re
 import shutil
+import signal
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
 
@@ -21,24 +30,247 @@ logger = logging.getLogger(__name__)
 
 # Constants
 DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_BYTES = 2 * 1024 ** 3
 PROGRESS_UPDATE_INTERVAL = 1000
+PROGRESS_BAR_STEP = 256  # Files per tqdm update in per-file loops
+MKSQUASHFS_OUTPUT_TAIL = 64  # Lines of mksquashfs output kept for error reporting
+COPY_BUFSIZE = 1 << 20
+
+
+def _fast_rmtree(path, ignore_errors=False):
+    """Remove a directory tree, using native rm -rf on POSIX (much faster than shutil.rmtree on large trees)"""
+    if os.name == 'posix':
+        subprocess.run(['rm', '-rf', '--', str(path)], check=not ignore_errors)
+    else:
+        shutil.rmtree(path, ignore_errors=ignore_errors)
+
+
+def _empty_dir_fd(dir_fd):
+    """Remove everything inside the directory open as dir_fd"""
+    with os.scandir(dir_fd) as it:
+        entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in it]
+    for name, is_dir in entries:
+        if is_dir:
+            _rmtree_at(dir_fd, name)
+        else:
+            os.unlink(name, dir_fd=dir_fd)
+
+
+def _rmtree_at(dir_fd, name):
+    """Remove the directory tree `name` relative to dir_fd"""
+    fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=dir_fd)
+    try:
+        _empty_dir_fd(fd)
+    finally:
+        os.close(fd)
+    os.rmdir(name, dir_fd=dir_fd)
+
+
+def _empty_dir(path):
+    """Empty a directory but keep it, resolving entries relative to open dir fds instead of full paths"""
+    if os.scandir not in os.supports_fd or os.unlink not in os.supports_dir_fd:
+        _fast_rmtree(path)
+        os.makedirs(path)
+        return
+    
+    dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        _empty_dir_fd(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+@contextmanager
+def open_tar(path):
+    """Open a tar.gz archive for sequential reading, decompressing with pigz when available"""
+    pigz = shutil.which('pigz')
+    if pigz is None:
+        # Stream mode treats a truncated header as the end of the archive, only gzip notices the truncation
+        try:
+            with open(path, 'rb', buffering=COPY_BUFSIZE) as raw, gzip.GzipFile(fileobj=raw) as gz:
+                with tarfile.open(fileobj=gz, mode='r|', bufsize=COPY_BUFSIZE, copybufsize=COPY_BUFSIZE) as tar:
+                    yield tar
+                # Read on to the end-of-stream marker and CRC check after the tar end blocks
+                while gz.read(COPY_BUFSIZE):
+                    pass
+        except (EOFError, gzip.BadGzipFile) as e:
+            raise tarfile.ReadError(f"{path} is truncated or not a valid gzip file ({e})")
+        return
+    
+    proc = subprocess.Popen([pigz, '-dc', str(path)], stdout=subprocess.PIPE, bufsize=COPY_BUFSIZE)
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|', bufsize=COPY_BUFSIZE, copybufsize=COPY_BUFSIZE) as tar:
+            yield tar
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        proc.stdout.close()
+    
+    # pigz is killed by SIGPIPE when we stop reading before the end of its output
+    if proc.wait() not in (0, -signal.SIGPIPE):
+        raise tarfile.ReadError(f"pigz failed to decompress {path}")
+
+
+def _uncompressed_size(archive_path):
+    """Uncompressed size of a gzip file, read from its trailer
+
+    The trailer only holds the size modulo 4 GiB, so take the smallest matching size
+    that is not below the compressed size.
+    """
+    size = archive_path.stat().st_size
+    try:
+        with open(archive_path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            isize = int.from_bytes(f.read(4), 'little')
+    except OSError:
+        return size
+    return isize + ((max(size - isize, 0) + 0xFFFFFFFF) >> 32 << 32)
+
+
+def _name_digest(name):
+    """64-bit digest of a name; sets of these take a fraction of the memory of the names themselves"""
+    return hash(name) & 0xFFFFFFFFFFFFFFFF
+
+
+def _top_dir(name):
+    """Top-level directory of a tar member name, None for bare file names (no Path allocation)"""
+    name = name.lstrip('/')
+    while name.startswith('./'):
+        name = name[2:]
+    i = name.find('/')
+    if i > 0:
+        return name[:i]
+    # Skip if it's just a filename without directory
+    if i == 0 or not name or name == '.' or '.' in name:
+        return None
+    return name
+
+
+def _filtered_name(member):
+    """Normalised member name as tarfile.data_filter would extract it
+
+    Leading slashes are stripped; only names that resolve outside the destination are rejected.
+    """
+    name = posixpath.normpath(member.name.lstrip('/') or '.')
+    if name == '..' or name.startswith('../'):
+        raise tarfile.OutsideDestinationError(member, name)
+    return name
+
+
+def _filtered_mode(member):
+    """Permission bits as tarfile.data_filter would apply them"""
+    mode = member.mode & 0o755
+    if member.isfile():
+        mode |= 0o600
+        # Not executable by the owner means not executable at all
+        if not mode & 0o100:
+            mode &= ~0o111
+    return mode
+
+
+_REGENERATED_PAX_KEYS = frozenset(('path', 'linkpath', 'size', 'uid', 'gid', 'uname', 'gname'))
+
+
+def _stream_pax_headers(member):
+    """PAX headers of a member minus those tobuf() regenerates from the (possibly renamed) TarInfo
+
+    A stale 'path' or owner header would override the new name and ownership, and the
+    sparse map and stored size no longer apply once the data is written out in full.
+    """
+    return {key: value for key, value in member.pax_headers.items()
+            if key not in _REGENERATED_PAX_KEYS and not key.startswith('GNU.sparse.')}
+
+
+def _extract_file_member(tar, member, dest_root, created_parents):
+    """Stream a regular file member from the tar to dest_root, skipping mkdir for parents in created_parents"""
+    dst = Path(dest_root) / _filtered_name(member)
+    parent = dst.parent
+    if parent not in created_parents:
+        parent.mkdir(parents=True, exist_ok=True)
+        created_parents.add(parent)
+    
+    src_f = tar.extractfile(member)
+    with open(dst, 'wb') as out:
+        shutil.copyfileobj(src_f, out, length=COPY_BUFSIZE)
+    
+    os.chmod(dst, _filtered_mode(member))
+    os.utime(dst, (member.mtime, member.mtime))
+    return dst
+
+
+def _extract_archive_worker(archive_path, dest_dir, merge_duplicates, dry_run):
+    """Extract all regular files of an archive into dest_dir (runs in a worker process)
+
+    A module-level function so that submitting it only pickles its arguments, not the builder.
+    """
+    file_count = 0
+    top_dirs = set()
+    created_parents = set()
+    try:
+        with open_tar(archive_path) as tar:
+            for member in tar:
+                is_file = member.isfile()
+                if merge_duplicates and (is_file or member.isdir()):
+                    top_dir = _top_dir(member.name)
+                    if top_dir:
+                        top_dirs.add(top_dir)
+                if is_file:
+                    if not dry_run:
+                        _extract_file_member(tar, member, dest_dir, created_parents)
+                    file_count += 1
+    except tarfile.TarError as e:
+        raise RuntimeError(f"Corrupted or invalid tar file: {archive_path} ({e})")
+    return file_count, top_dirs
+
+
+class _TarStreamWriter:
+    """Minimal sequential PAX tar writer for the mksquashfs -tar pipe
+
+    Unlike TarFile in 'w|' mode it does no per-member bookkeeping (TarFile keeps
+    every TarInfo it wrote in .members), it just emits header blocks and raw data.
+    """
+    
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+    
+    def addfile(self, tarinfo, fileobj=None):
+        self.fileobj.write(tarinfo.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, 'surrogateescape'))
+        if fileobj is not None and tarinfo.size:
+            shutil.copyfileobj(fileobj, self.fileobj, COPY_BUFSIZE)
+            remainder = tarinfo.size % tarfile.BLOCKSIZE
+            if remainder:
+                self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+    
+    def close(self):
+        # End-of-archive marker is two zero blocks
+        self.fileobj.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        self.fileobj.flush()
 
 
 class SquashFSBuilder:
-    def __init__(self, output_file, batch_size=1000, compression='xz', temp_dir=None, temp_base=None, dry_run=False, merge_duplicates=True):
+    def __init__(self, output_file, batch_size=1000, batch_bytes=DEFAULT_BATCH_BYTES, compression='xz', temp_dir=None, temp_base=None, dry_run=False, merge_duplicates=True, stream_tar=False, jobs=1, mksquashfs_idle_timeout=None):
         self.output_file = Path(output_file).absolute()
         self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
         self.compression = compression
         self.temp_dir = temp_dir
         self.temp_base = temp_base
         self.files_in_batch = 0
+        self.bytes_in_batch = 0
         self.total_files = 0
         self.current_batch_dir = None
         self.dry_run = dry_run
         self.merge_duplicates = merge_duplicates
-        self.seen_top_dirs = set()  # Track top-level directories we've seen
+        self.stream_tar = stream_tar  # None: use mksquashfs -tar if it is supported
+        self.jobs = jobs
+        self.mksquashfs_idle_timeout = mksquashfs_idle_timeout  # Seconds without output before mksquashfs is killed
+        self.seen_top_dirs = set()  # 64-bit digests of the top-level directories we've seen
         self.merge_base_dir = None  # Base directory for merging
         self.global_merge_dir = None  # Global merge directory across all archives
+        self._dry_run_batch_count = 0  # Files that would have been appended next (dry run only)
+        self._created_parents = set()  # Directories already created in the current staging dir
         
     @contextmanager
     def temp_directory(self, prefix="squashfs_"):
@@ -50,7 +282,7 @@ class SquashFSBuilder:
                 logger.debug(f"Created temporary directory: {temp_dir}")
                 yield temp_dir
             finally:
-                shutil.rmtree(temp_dir, ignore_errors=True)
+                _fast_rmtree(temp_dir, ignore_errors=True)
         else:
             temp_dir = Path(self.temp_dir)
             if not temp_dir.exists():
@@ -59,7 +291,7 @@ class SquashFSBuilder:
                 logger.debug(f"Created temporary directory: {temp_dir}")
                 yield temp_dir
             finally:
-                shutil.rmtree(temp_dir, ignore_errors=True)
+                _fast_rmtree(temp_dir, ignore_errors=True)
 
     
     def check_tools(self):
@@ -69,13 +301,24 @@ class SquashFSBuilder:
                          capture_output=True, check=True)
         except (subprocess.CalledProcessError, FileNotFoundError):
             raise RuntimeError("mksquashfs not found. Please install squashfs-tools")
+        
+        if self.stream_tar and not self.supports_tar_input():
+            raise RuntimeError("mksquashfs does not support -tar input (squashfs-tools >= 4.6 required)")
     
-    def check_disk_space(self, required_space_mb=100):
-        """Check if there's sufficient disk space"""
+    def supports_tar_input(self):
+        """Check whether mksquashfs can read a tar archive from stdin"""
+        try:
+            result = subprocess.run(['mksquashfs', '-help'], capture_output=True, text=True)
+        except FileNotFoundError:
+            return False
+        return re.search(r'^\s*-tar\b', result.stdout + result.stderr, re.MULTILINE) is not None
+    
+    def check_disk_space(self, required_space_mb=100, path=None):
+        """Check if there's sufficient disk space where path lives (default: the output directory)"""
         if self.dry_run:
             return
         
-        output_dir = self.output_file.parent
+        output_dir = self.output_file.parent if path is None else path
         try:
             stat = os.statvfs(output_dir)
             free_space_mb = (stat.f_bavail * stat.f_frsize) / (1024 * 1024)
@@ -85,6 +328,13 @@ class SquashFSBuilder:
             # Windows doesn't have statvfs, skip check
             pass
     
+    def check_archive_disk_space(self, archive_path):
+        """Check disk space once per archive, with a margin scaled to the archive size"""
+        if self.dry_run:
+            return
+        required_space_mb = max(100, 2 * archive_path.stat().st_size // (1024 * 1024))
+        self.check_disk_space(required_space_mb)
+    
     def initialize_squashfs(self):
         """Create initial empty squashfs file"""
         if self.dry_run:
@@ -99,39 +349,80 @@ class SquashFSBuilder:
             if self.compression:
                 cmd.extend(['-comp', self.compression])
             
-            subprocess.run(cmd, check=True, capture_output=True)
+            returncode, output = self.run_mksquashfs(cmd)
+            if returncode != 0:
+                logger.error(f"mksquashfs error: {output}")
+                raise RuntimeError(f"Failed to initialize squashfs: {output}")
             logger.info(f"Initialized SquashFS file: {self.output_file}")
     
+    def run_mksquashfs(self, cmd):
+        """Run mksquashfs, killing it only if it stays silent for longer than the idle timeout
+
+        Output is streamed rather than buffered, only the last lines are kept for error messages.
+        """
+        # stdout carries the progress output, so merge it into the stream we watch
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        lines = deque(maxlen=MKSQUASHFS_OUTPUT_TAIL)
+        last_output = time.monotonic()
+        
+        def drain():
+            nonlocal last_output
+            try:
+                # Binary pipe: warnings may quote file names from the tars that aren't valid UTF-8
+                for line in proc.stdout:
+                    lines.append(line.decode(errors='replace'))
+                    last_output = time.monotonic()
+            finally:
+                # Never leave the pipe unread, mksquashfs would block on it forever
+                while proc.stdout.read(COPY_BUFSIZE):
+                    pass
+        
+        reader = threading.Thread(target=drain, daemon=True)
+        reader.start()
+        try:
+            while True:
+                try:
+                    proc.wait(timeout=1)
+                    break
+                except subprocess.TimeoutExpired:
+                    idle = time.monotonic() - last_output
+                    if self.mksquashfs_idle_timeout is not None and idle > self.mksquashfs_idle_timeout:
+                        raise RuntimeError(f"mksquashfs produced no output for {idle:.0f} seconds, killed it")
+        except BaseException:
+            # Idle timeout, Ctrl-C or anything else: don't leave mksquashfs running
+            proc.kill()
+            proc.wait()
+            reader.join()
+            raise
+        reader.join()
+        return proc.returncode, ''.join(lines)
+    
     def append_to_squashfs(self, source_dir):
         """Append a directory to the squashfs file"""
         if self.dry_run:
-            file_count = sum(1 for _ in Path(source_dir).rglob('*') if _.is_file())
-            logger.info(f"[DRY RUN] Would append {file_count} files from {source_dir}")
+            logger.info(f"[DRY RUN] Would append {self._dry_run_batch_count} files from {source_dir}")
+            self._dry_run_batch_count = 0
             return
         
+        # Size tracking costs two stat() calls per batch, only pay for it with -v
+        track_size = logger.isEnabledFor(logging.DEBUG)
         size_before = 0
-        if logging.DEBUG >= logging.root.level:
+        if track_size:
             size_before = self.output_file.stat().st_size if self.output_file.exists() else 0
-            
-        # Check disk space before operation
-        self.check_disk_space()
         
         cmd = ['mksquashfs', source_dir, str(self.output_file)]
         if self.compression:
             cmd.extend(['-comp', self.compression])
         
-        try:
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        except subprocess.TimeoutExpired:
-            raise RuntimeError("mksquashfs operation timed out after 5 minutes")
+        returncode, output = self.run_mksquashfs(cmd)
         
-        if result.returncode != 0:
-            logger.error(f"mksquashfs error: {result.stderr}")
-            if "No space left on device" in result.stderr:
+        if returncode != 0:
+            logger.error(f"mksquashfs error: {output}")
+            if "No space left on device" in output:
                 raise RuntimeError("Insufficient disk space for mksquashfs operation")
-            raise RuntimeError(f"Failed to append to squashfs: {result.stderr}")
+            raise RuntimeError(f"Failed to append to squashfs: {output}")
         
-        if logging.DEBUG >= logging.root.level:
+        if track_size:
             size_after = self.output_file.stat().st_size
             if size_after < size_before:
                 logger.warning(f"WARNING: SquashFS file size decreased! Was {size_before}, now {size_after}")
@@ -140,34 +431,20 @@ class SquashFSBuilder:
                 size_diff = size_after - size_before
                 logger.debug(f"  SquashFS grew by {size_diff / 1024 / 1024:.1f} MB (total: {size_after / 1024 / 1024:.1f} MB)")
     
-    def get_top_level_dir(self, member_path):
-        """Get the top-level directory from a tar member path"""
-        if not member_path or member_path == '.':
-            return None
-        parts = Path(member_path).parts
-        if not parts:
-            return None
-        # Skip if it's just a filename without directory
-        if len(parts) == 1 and '.' in parts[0]:
-            return None
-        return parts[0]
-    
-    def setup_merge_directory(self, extract_path, top_dir):
-        """Setup directory structure for merging duplicate top-level directories"""
-        if not self.merge_duplicates or not top_dir:
-            return extract_path
-        
-        if self.merge_base_dir is None:
-            self.merge_base_dir = extract_path / "merged"
-            if not self.dry_run:
-                self.merge_base_dir.mkdir(exist_ok=True)
-        
-        # Create the target directory in the merge base
-        target_dir = self.merge_base_dir / top_dir
-        if not self.dry_run:
-            target_dir.mkdir(exist_ok=True)
-        
-        return self.merge_base_dir
+    def extract_file_member(self, tar, member, dest_root):
+        """Stream a regular file member from the tar directly to dest_root"""
+        return _extract_file_member(tar, member, dest_root, self._created_parents)
+    
+    def track_top_dir(self, top_dir, archive_top_dirs):
+        """Record a top-level directory, logging the first time a duplicate is hit in this archive"""
+        if not top_dir or top_dir in archive_top_dirs:
+            return
+        archive_top_dirs.add(top_dir)
+        digest = _name_digest(top_dir)
+        if digest in self.seen_top_dirs:
+            logger.info(f"  Merging duplicate directory: {top_dir}")
+        else:
+            self.seen_top_dirs.add(digest)
     
     def _analyze_archives(self, archive_list):
         """Analyze archives to identify duplicate directories"""
@@ -177,11 +454,11 @@ class SquashFSBuilder:
         for archive in pbar:
             try:
                 pbar.set_postfix_str(f"Analyzing {archive.name}")
-                with tarfile.open(archive, 'r:gz') as tar:
+                with open_tar(archive) as tar:
                     dirs = set()
                     for member in tar:
                         if member.isfile() or member.isdir():
-                            top_dir = self.get_top_level_dir(member.name)
+                            top_dir = _top_dir(member.name)
                             if top_dir:
                                 dirs.add(top_dir)
                     archive_dirs[archive] = dirs
@@ -209,35 +486,20 @@ class SquashFSBuilder:
         """Process only the duplicate directory content with merging"""
         if not self.dry_run:
             global_merge_dir = tempfile.mkdtemp(prefix="global_merge_")
+        self._created_parents.clear()
         
         try:
             for archive in archive_list:
-                archive_has_duplicates = False
-                
                 try:
-                    with tarfile.open(archive, 'r:gz') as tar:
-                        # Check if this archive has duplicate content
-                        for member in tar:
-                            if member.isfile():
-                                top_dir = self.get_top_level_dir(member.name)
-                                if top_dir in duplicate_dirs:
-                                    archive_has_duplicates = True
-                                    break
-                        
-                        if not archive_has_duplicates:
-                            continue
-                        
-                        # Reset tar position and extract only duplicate directory content
-                        tar.close()
-                        tar = tarfile.open(archive, 'r:gz')
-                        
+                    # Extract only duplicate directory content
+                    with open_tar(archive) as tar:
                         extracted_files = 0
                         for member in tar:
                             if member.isfile():
-                                top_dir = self.get_top_level_dir(member.name)
+                                top_dir = _top_dir(member.name)
                                 if top_dir in duplicate_dirs:
                                     if not self.dry_run:
-                                        tar.extract(member, path=global_merge_dir, filter=tarfile.data_filter)
+                                        self.extract_file_member(tar, member, global_merge_dir)
                                     extracted_files += 1
                                     self.total_files += 1
                         
@@ -250,29 +512,33 @@ class SquashFSBuilder:
             # Append merged content if any
             if not self.dry_run and os.path.exists(global_merge_dir) and os.listdir(global_merge_dir):
                 logger.info("Appending merged duplicate content to SquashFS...")
+                self.check_disk_space()
                 self.append_to_squashfs(global_merge_dir)
         
         finally:
             if not self.dry_run and 'global_merge_dir' in locals():
-                shutil.rmtree(global_merge_dir, ignore_errors=True)
+                _fast_rmtree(global_merge_dir, ignore_errors=True)
     
     def process_tar_member(self, tar, member, extract_path, top_dir=None):
-        """Process a single member from tar archive"""
-        if member.isfile():
+        """Process a single regular file member from tar archive (callers filter on isfile())"""
+        if not self.dry_run:
+            # Always extract to local temp directory for efficiency
+            self.extract_file_member(tar, member, extract_path)
+        else:
+            self._dry_run_batch_count += 1
+        
+        self.files_in_batch += 1
+        self.bytes_in_batch += member.size
+        self.total_files += 1
+        
+        if self.files_in_batch >= self.batch_size or self.bytes_in_batch >= self.batch_bytes:
+            logger.debug(f"  Appending batch of {self.files_in_batch} files...")
+            self.append_to_squashfs(extract_path)
             if not self.dry_run:
-                # Always extract to local temp directory for efficiency
-                tar.extract(member, path=extract_path, filter=tarfile.data_filter)
-            
-            self.files_in_batch += 1
-            self.total_files += 1
-            
-            if self.files_in_batch >= self.batch_size:
-                logger.debug(f"  Appending batch of {self.files_in_batch} files...")
-                if not self.dry_run:
-                    self.append_to_squashfs(extract_path)
-                    shutil.rmtree(extract_path)
-                    os.makedirs(extract_path)
-                self.files_in_batch = 0
+                _empty_dir(extract_path)
+                self._created_parents.clear()
+            self.files_in_batch = 0
+            self.bytes_in_batch = 0
     
     def process_archive_streaming(self, archive_path):
         """Process a tar.gz archive with streaming extraction"""
@@ -280,52 +546,38 @@ class SquashFSBuilder:
         
         with self.temp_directory(prefix="extract_") as extract_dir:
             self.files_in_batch = 0
+            self.bytes_in_batch = 0
+            self._created_parents.clear()
             archive_top_dirs = set()
             
             # Note: When merging, files go directly to global_merge_dir
             # No need to reset merge_base_dir as it's not used in merge mode
             
             try:
-                with tarfile.open(archive_path, 'r:gz') as tar:
-                    # First pass: identify top-level directories
-                    if self.merge_duplicates:
-                        for member in tar:
-                            if member.isfile() or member.isdir():
-                                top_dir = self.get_top_level_dir(member.name)
-                                if top_dir:
-                                    archive_top_dirs.add(top_dir)
-                        
-                        # Check for duplicates and log merge operations
-                        duplicate_dirs = archive_top_dirs.intersection(self.seen_top_dirs)
-                        if duplicate_dirs:
-                            logger.info(f"  Merging duplicate directories: {', '.join(duplicate_dirs)}")
-                        
-                        # Update seen directories
-                        self.seen_top_dirs.update(archive_top_dirs)
-                        
-                        # Reset tar file position for second pass
-                        tar.close()
-                        tar = tarfile.open(archive_path, 'r:gz')
-                    
+                with open_tar(archive_path) as tar:
                     file_count = 0
-                    pbar = tqdm(desc=f"Processing {archive_path.name}", unit="file", dynamic_ncols=True)
+                    pbar = tqdm(desc=f"Processing {archive_path.name}", unit="file", dynamic_ncols=True, mininterval=0.5)
                     
                     for member in tar:
-                        if member.isfile():
+                        is_file = member.isfile()
+                        top_dir = None
+                        if self.merge_duplicates and (is_file or member.isdir()):
+                            top_dir = _top_dir(member.name)
+                            self.track_top_dir(top_dir, archive_top_dirs)
+                        
+                        if is_file:
                             file_count += 1
-                            top_dir = self.get_top_level_dir(member.name) if self.merge_duplicates else None
-                            # Setup merge directory if we have a valid top_dir
-                            if self.merge_duplicates and top_dir:
-                                self.setup_merge_directory(extract_dir, top_dir)
                             self.process_tar_member(tar, member, extract_dir, top_dir)
-                            pbar.update(1)
+                            if file_count % PROGRESS_BAR_STEP == 0:
+                                pbar.update(PROGRESS_BAR_STEP)
                             
-                            if logging.DEBUG >= logging.root.level and file_count % PROGRESS_UPDATE_INTERVAL == 0:
+                            if file_count % PROGRESS_UPDATE_INTERVAL == 0 and logger.isEnabledFor(logging.DEBUG):
                                 logger.debug(f"    Processed {file_count} files...")
                                 if self.output_file.exists():
                                     current_size = self.output_file.stat().st_size / 1024 / 1024
                                     logger.debug(f"    Current SquashFS size: {current_size:.1f} MB")
                     
+                    pbar.update(file_count % PROGRESS_BAR_STEP)
                     pbar.close()
                     logger.info(f"  Found {file_count} files in archive")
                     
@@ -346,99 +598,264 @@ class SquashFSBuilder:
         
         with self.temp_directory(prefix="batch_") as batch_dir:
             self.files_in_batch = 0
+            self.bytes_in_batch = 0
+            self._created_parents.clear()
+            # The previous archive's staging dir is gone, start a new merge dir
+            self.merge_base_dir = None
             archive_top_dirs = set()
             
-            # First pass: identify top-level directories if merging
-            if self.merge_duplicates:
-                with tarfile.open(archive_path, 'r:gz') as tar:
-                    for member in tar:
-                        if member.isfile() or member.isdir():
-                            top_dir = self.get_top_level_dir(member.name)
-                            if top_dir:
-                                archive_top_dirs.add(top_dir)
-                
-                # Check for duplicates and log merge operations
-                duplicate_dirs = archive_top_dirs.intersection(self.seen_top_dirs)
-                if duplicate_dirs:
-                    logger.info(f"  Merging duplicate directories: {', '.join(duplicate_dirs)}")
-                
-                # Update seen directories
-                self.seen_top_dirs.update(archive_top_dirs)
-            
-            with tarfile.open(archive_path, 'r:gz') as tar:
-                pbar = tqdm()
+            with open_tar(archive_path) as tar:
+                file_count = 0
+                pbar = tqdm(desc=f"Processing {archive_path.name}", unit="file", dynamic_ncols=True, mininterval=0.5)
                 for member in tar:
-                    if member.isfile():
+                    is_file = member.isfile()
+                    top_dir = None
+                    if self.merge_duplicates and (is_file or member.isdir()):
+                        top_dir = _top_dir(member.name)
+                        self.track_top_dir(top_dir, archive_top_dirs)
+                    
+                    if is_file:
                         if not self.dry_run:
-                            # Get top directory for this member
-                            top_dir = self.get_top_level_dir(member.name) if self.merge_duplicates else None
-                            
                             if self.merge_duplicates and top_dir:
                                 # Setup merge directory structure
                                 if self.merge_base_dir is None:
                                     self.merge_base_dir = batch_dir / "merged"
                                     self.merge_base_dir.mkdir(exist_ok=True)
                                 
-                                temp_extract = Path(batch_dir) / "temp_extract"
-                                temp_extract.mkdir(exist_ok=True)
-                                
-                                tar.extract(member, path=temp_extract, filter=tarfile.data_filter)
-                                
-                                src = temp_extract / member.name
-                                dst = self.merge_base_dir / member.name
-                                dst.parent.mkdir(parents=True, exist_ok=True)
-                                
-                                if dst.exists():
+                                if logger.isEnabledFor(logging.DEBUG) and (self.merge_base_dir / member.name).exists():
                                     logger.debug(f"  Overwriting duplicate file: {member.name}")
-                                shutil.move(str(src), str(dst))
-                                
-                                shutil.rmtree(temp_extract)
+                                self.extract_file_member(tar, member, self.merge_base_dir)
                             else:
-                                temp_extract = Path(batch_dir) / "temp_extract"
-                                temp_extract.mkdir(exist_ok=True)
-                                
-                                tar.extract(member, path=temp_extract, filter=tarfile.data_filter)
-                                
-                                src = temp_extract / member.name
-                                dst = Path(batch_dir) / member.name
-                                dst.parent.mkdir(parents=True, exist_ok=True)
-                                shutil.move(str(src), str(dst))
-                                
-                                shutil.rmtree(temp_extract)
+                                self.extract_file_member(tar, member, batch_dir)
+                        else:
+                            self._dry_run_batch_count += 1
                         
-                        pbar.update(1)
+                        file_count += 1
+                        if file_count % PROGRESS_BAR_STEP == 0:
+                            pbar.update(PROGRESS_BAR_STEP)
                         self.files_in_batch += 1
+                        self.bytes_in_batch += member.size
                         self.total_files += 1
                         
-                        if self.files_in_batch >= self.batch_size:
+                        if self.files_in_batch >= self.batch_size or self.bytes_in_batch >= self.batch_bytes:
                             logger.debug(f"  Appending batch of {self.files_in_batch} files...")
                             append_path = self.merge_base_dir if self.merge_duplicates and self.merge_base_dir else batch_dir
                             self.append_to_squashfs(append_path)
                             if not self.dry_run:
                                 if self.merge_duplicates and self.merge_base_dir:
-                                    shutil.rmtree(self.merge_base_dir)
-                                    self.merge_base_dir = batch_dir / "merged"
-                                    self.merge_base_dir.mkdir(exist_ok=True)
+                                    _empty_dir(self.merge_base_dir)
                                 else:
-                                    shutil.rmtree(batch_dir)
-                                    os.makedirs(batch_dir)
+                                    _empty_dir(batch_dir)
+                                self._created_parents.clear()
                             self.files_in_batch = 0
+                            self.bytes_in_batch = 0
+                
+                pbar.update(file_count % PROGRESS_BAR_STEP)
+                pbar.close()
                 
                 if self.files_in_batch > 0:
                     logger.debug(f"  Appending final batch of {self.files_in_batch} files...")
                     append_path = self.merge_base_dir if self.merge_duplicates and self.merge_base_dir else batch_dir
                     self.append_to_squashfs(append_path)
     
+    def process_archives_parallel(self, archive_list):
+        """Extract archives concurrently into private staging dirs and append them serially in order"""
+        # Fresh interpreters instead of fork(): workers don't inherit the parent's memory and open pipes
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        mp_context = multiprocessing.get_context(start_method)
+        with self.temp_directory(prefix="parallel_") as staging_root:
+            with ProcessPoolExecutor(max_workers=self.jobs, mp_context=mp_context) as pool:
+                pending = deque()
+                next_index = 0
+                pbar = tqdm(total=len(archive_list), desc="Processing archives", unit="archive", dynamic_ncols=True)
+                try:
+                    while pending or next_index < len(archive_list):
+                        # Keep every worker busy while the head is appended, but bound the staged archives
+                        while next_index < len(archive_list) and len(pending) <= self.jobs:
+                            archive = archive_list[next_index]
+                            staging_dir = staging_root / f"archive_{next_index}"
+                            # Room for this archive and every one still staged, each fully extracted
+                            staged_bytes = _uncompressed_size(archive)
+                            staged_bytes += sum(_uncompressed_size(a) for a, _, _ in pending)
+                            self.check_disk_space(max(100, staged_bytes // (1024 * 1024)), staging_root)
+                            future = pool.submit(_extract_archive_worker, archive, staging_dir,
+                                                 self.merge_duplicates, self.dry_run)
+                            pending.append((archive, staging_dir, future))
+                            next_index += 1
+                        
+                        archive, staging_dir, future = pending.popleft()
+                        file_count, top_dirs = future.result()
+                        logger.info(f"Processed: {archive.name} ({file_count} files)")
+                        
+                        archive_top_dirs = set()
+                        for top_dir in sorted(top_dirs):
+                            self.track_top_dir(top_dir, archive_top_dirs)
+                        
+                        self.total_files += file_count
+                        if file_count > 0:
+                            if self.dry_run:
+                                logger.info(f"[DRY RUN] Would append {file_count} files from {archive.name}")
+                            else:
+                                self.check_archive_disk_space(archive)
+                                self.append_to_squashfs(staging_dir)
+                                _fast_rmtree(staging_dir)
+                        pbar.update(1)
+                except BaseException:
+                    pool.shutdown(cancel_futures=True)
+                    raise
+                finally:
+                    pbar.close()
+    
+    def process_archives(self, archive_list, memory_efficient=False, label="archive"):
+        """Process archives one after another, or concurrently when jobs > 1"""
+        if self.jobs > 1 and not memory_efficient:
+            self.process_archives_parallel(archive_list)
+            return
+        
+        for i, archive in enumerate(archive_list, 1):
+            logger.info(f"[{i}/{len(archive_list)}] Processing {label}...")
+            self.check_archive_disk_space(archive)
+            if memory_efficient:
+                self.process_archive_memory_efficient(archive)
+            else:
+                self.process_archive_streaming(archive)
+    
+    def stream_archive(self, archive_path, out_tar, emitted_paths):
+        """Copy files and directories of one archive into the output tar stream"""
+        logger.info(f"Streaming: {archive_path.name}")
+        archive_top_dirs = set()
+        renamed_top_dirs = {}
+        # Extracted files belong to the invoking user, so the streamed ones do as well
+        uid, gid = os.getuid(), os.getgid()
+        
+        try:
+            with open_tar(archive_path) as tar:
+                file_count = 0
+                pbar = tqdm(desc=f"Streaming {archive_path.name}", unit="file", dynamic_ncols=True, mininterval=0.5)
+                
+                for member in tar:
+                    is_file = member.isfile()
+                    if not (is_file or member.isdir()):
+                        continue
+                    name = _filtered_name(member)
+                    if name == '.':
+                        continue
+                    
+                    if self.merge_duplicates:
+                        self.track_top_dir(_top_dir(name), archive_top_dirs)
+                        # Directories are merged; for files the first one written wins
+                        digest = _name_digest(name)
+                        if digest in emitted_paths:
+                            if is_file:
+                                logger.debug(f"  Skipping duplicate file: {name}")
+                            continue
+                        emitted_paths.add(digest)
+                    else:
+                        # Any clashing root-level entry, file or directory, gets the suffix mksquashfs
+                        # gives it when appending, which also keeps every path unique
+                        root = name.partition('/')[0]
+                        if root not in archive_top_dirs:
+                            archive_top_dirs.add(root)
+                            if _name_digest(root) in self.seen_top_dirs:
+                                suffix = 1
+                                while _name_digest(f"{root}_{suffix}") in self.seen_top_dirs:
+                                    suffix += 1
+                                renamed_top_dirs[root] = f"{root}_{suffix}"
+                                logger.info(f"  Renaming duplicate entry: {root} -> {renamed_top_dirs[root]}")
+                            self.seen_top_dirs.add(_name_digest(renamed_top_dirs.get(root, root)))
+                        if root in renamed_top_dirs:
+                            name = renamed_top_dirs[root] + name[len(root):]
+                    
+                    if out_tar is not None:
+                        info = member.replace(name=name, mode=_filtered_mode(member),
+                                              uid=uid, gid=gid, uname='', gname='', deep=False)
+                        info.pax_headers = _stream_pax_headers(member)
+                        if is_file:
+                            # Sparse and contiguous files are written out as plain files
+                            info.type = tarfile.REGTYPE
+                        out_tar.addfile(info, tar.extractfile(member) if is_file else None)
+                    
+                    if is_file:
+                        file_count += 1
+                        self.total_files += 1
+                        if file_count % PROGRESS_BAR_STEP == 0:
+                            pbar.update(PROGRESS_BAR_STEP)
+                
+                pbar.update(file_count % PROGRESS_BAR_STEP)
+                pbar.close()
+                logger.info(f"  Found {file_count} files in archive")
+        
+        except tarfile.TarError as e:
+            logger.error(f"Error reading tar file {archive_path}: {e}")
+            raise RuntimeError(f"Corrupted or invalid tar file: {archive_path}")
+    
+    def stream_archives(self, archive_list, out_tar):
+        """Write all archives into out_tar (None for a dry run), each path only once"""
+        emitted_paths = set()  # 64-bit digests of the paths written so far
+        total_archives = len(archive_list)
+        
+        # The first copy of a path written wins. When merging, stream the archives last to first so
+        # the copy from the last archive is kept, like the staged pipeline that overwrites earlier ones
+        if self.merge_duplicates:
+            archive_list = archive_list[::-1]
+        
+        for i, archive in enumerate(archive_list, 1):
+            logger.info(f"[{i}/{total_archives}] Streaming archive...")
+            self.check_archive_disk_space(archive)
+            self.stream_archive(archive, out_tar, emitted_paths)
+    
+    def process_archives_tar_stream(self, archive_list):
+        """Pipe all archives through a single mksquashfs -tar process, without a staging directory"""
+        if self.dry_run:
+            self.stream_archives(archive_list, None)
+            return
+        
+        cmd = ['mksquashfs', '-', str(self.output_file), '-tar', '-noappend', '-quiet']
+        if self.compression:
+            cmd.extend(['-comp', self.compression])
+        
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, bufsize=COPY_BUFSIZE)
+        try:
+            out_tar = _TarStreamWriter(proc.stdin)
+            self.stream_archives(archive_list, out_tar)
+            out_tar.close()
+            proc.stdin.close()
+        except BrokenPipeError:
+            # mksquashfs exited early, its exit status is reported below
+            pass
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        
+        if proc.wait() != 0:
+            raise RuntimeError(f"mksquashfs failed with exit code {proc.returncode}")
+    
+    def resolve_stream_tar(self):
+        """Settle an auto-detected (None) stream_tar by asking mksquashfs whether it supports -tar"""
+        if self.stream_tar is None:
+            self.stream_tar = self.supports_tar_input()
+            if self.stream_tar:
+                logger.info("mksquashfs supports -tar, streaming all archives through a single mksquashfs process")
+            else:
+                logger.info("mksquashfs does not support -tar (squashfs-tools < 4.6), appending staged batches")
+        return self.stream_tar
+    
     def build_from_archives(self, archive_list, memory_efficient=False):
         """Build squashfs from list of archives"""
+        self.resolve_stream_tar()
         if not self.dry_run:
             self.check_tools()
-        self.initialize_squashfs()
+        if not self.stream_tar:
+            self.initialize_squashfs()
         
         total_archives = len(archive_list)
         
         # Process archives - handle merging vs non-merging differently
-        if self.merge_duplicates:
+        if self.stream_tar:
+            # Single pass, no staging directory: mksquashfs reads one tar stream
+            self.process_archives_tar_stream(archive_list)
+        elif self.merge_duplicates:
             # For merging: collect duplicate dirs, process non-duplicates normally
             duplicate_dirs, non_duplicate_archives = self._analyze_archives(archive_list)
             
@@ -447,32 +864,17 @@ class SquashFSBuilder:
                 logger.info("Processing non-duplicate content first...")
                 
                 # Process archives with non-duplicate content normally (efficient)
-                for i, archive in enumerate(non_duplicate_archives, 1):
-                    logger.info(f"[{i}/{len(non_duplicate_archives)}] Processing non-duplicate archive...")
-                    if memory_efficient:
-                        self.process_archive_memory_efficient(archive)
-                    else:
-                        self.process_archive_streaming(archive)
+                self.process_archives(non_duplicate_archives, memory_efficient, label="non-duplicate archive")
                 
                 # Process duplicate content with merging (less efficient but necessary)
                 logger.info("Processing and merging duplicate directories...")
                 self._process_duplicate_content(archive_list, duplicate_dirs, memory_efficient)
             else:
                 # No duplicates found, process normally
-                for i, archive in enumerate(archive_list, 1):
-                    logger.info(f"[{i}/{total_archives}] Processing archive...")
-                    if memory_efficient:
-                        self.process_archive_memory_efficient(archive)
-                    else:
-                        self.process_archive_streaming(archive)
+                self.process_archives(archive_list, memory_efficient)
         else:
             # No merging - process all archives normally (most efficient)
-            for i, archive in enumerate(archive_list, 1):
-                logger.info(f"[{i}/{total_archives}] Processing archive...")
-                if memory_efficient:
-                    self.process_archive_memory_efficient(archive)
-                else:
-                    self.process_archive_streaming(archive)
+            self.process_archives(archive_list, memory_efficient)
         
         logger.info(f"Successfully processed {self.total_files} files from {total_archives} archives")
         if self.dry_run:
@@ -483,15 +885,19 @@ class SquashFSBuilder:
 
 def find_archives(directory):
     """Find all tar.gz archives in directory"""
-    archive_extensions = {'.tar.gz', '.tgz'}
+    archive_extensions = ('.tar.gz', '.tgz')
     archives = []
     
-    for file in Path(directory).iterdir():
-        if "temp" in file.name:
-            logger.debug(f"Skipping temporary file: {file.name}")
-            continue
-        if any(file.name.endswith(ext) for ext in archive_extensions):
-            archives.append(file)
+    with os.scandir(directory) as it:
+        for entry in it:
+            if not entry.name.endswith(archive_extensions):
+                continue
+            if "temp" in entry.name:
+                logger.debug(f"Skipping temporary file: {entry.name}")
+                continue
+            # DirEntry caches the file type from readdir, so regular files cost no extra stat
+            if entry.is_file():
+                archives.append(Path(entry.path))
     
     return sorted(archives)
 
@@ -526,13 +932,22 @@ Examples:
                         help='Output SquashFS file path (can be absolute or relative, default: dataset.sqfs)')
     parser.add_argument('-b', '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
                         help=f'Number of files to process before appending (default: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--batch-bytes', type=int, default=DEFAULT_BATCH_BYTES,
+                        help=f'Number of uncompressed bytes to process before appending (default: {DEFAULT_BATCH_BYTES})')
     valid_compressions = ['gzip', 'lzo', 'xz', 'lz4', 'zstd']
     parser.add_argument('-c', '--compression', choices=valid_compressions,
                         default='lz4', help='Compression algorithm (default: xz)')
     parser.add_argument('--memory-efficient', action='store_true',
                         help='Use ultra memory-efficient mode (slower but uses minimal inodes)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of archives to extract concurrently in streaming mode (default: 1)')
     parser.add_argument('--no-merge-duplicates', action='store_true',
                         help='Disable merging of duplicate top-level directories (default: merge enabled)')
+    parser.add_argument('--stream-tar', action=argparse.BooleanOptionalAction, default=False,
+                        help='Pipe archive contents straight into a single mksquashfs -tar process without a '
+                             'staging directory, requires squashfs-tools >= 4.6 (default: disabled)')
+    parser.add_argument('--mksquashfs-idle-timeout', type=float, default=None, metavar='SECONDS',
+                        help='Kill mksquashfs if it produces no output for this many seconds (default: no timeout)')
     parser.add_argument('--temp-dir', help='Temporary directory (default: system temp)')
     parser.add_argument('--dry-run', action='store_true',
                         help='Show what would be done without creating the squashfs file')
@@ -550,6 +965,14 @@ Examples:
         logger.error(f"Invalid compression: {args.compression}. Valid options: {', '.join(valid_compressions)}")
         sys.exit(1)
     
+    if args.jobs < 1:
+        logger.error(f"Invalid number of jobs: {args.jobs}. Must be at least 1")
+        sys.exit(1)
+    
+    if args.batch_bytes < 1:
+        logger.error(f"Invalid batch bytes: {args.batch_bytes}. Must be at least 1")
+        sys.exit(1)
+    
     # Find archives
     archives = find_archives(args.input_dir)
     if not archives:
@@ -569,27 +992,50 @@ Examples:
             logger.error(f"Output directory is not writable: {output_dir}")
             sys.exit(1)
     
-    logger.info("Configuration:")
-    logger.info(f"  Input directory: {args.input_dir}")
-    logger.info(f"  Output file: {output_path}")
-    logger.info(f"  Batch size: {args.batch_size}")
-    logger.info(f"  Compression: {args.compression}")
-    logger.info(f"  Mode: {'memory-efficient' if args.memory_efficient else 'streaming'}")
-    logger.info(f"  Merge duplicates: {'disabled' if args.no_merge_duplicates else 'enabled'}")
-    if args.temp_dir:
-        logger.info(f"  Temp directory: {args.temp_dir}")
-    if args.dry_run:
-        logger.info("  DRY RUN MODE - No files will be created")
+    # These only tune the staged pipeline
+    staged_options = [option for option, given in (
+        ('--memory-efficient', args.memory_efficient),
+        ('--jobs', args.jobs != 1),
+        ('--batch-size', args.batch_size != DEFAULT_BATCH_SIZE),
+        ('--batch-bytes', args.batch_bytes != DEFAULT_BATCH_BYTES),
+        ('--mksquashfs-idle-timeout', args.mksquashfs_idle_timeout is not None),
+    ) if given]
+    if staged_options and args.stream_tar:
+        logger.warning(f"Ignoring {', '.join(staged_options)}: only used without --stream-tar")
     
     # Build squashfs
     builder = SquashFSBuilder(
         output_file=output_path,
         batch_size=args.batch_size,
+        batch_bytes=args.batch_bytes,
         compression=args.compression,
         temp_dir=args.temp_dir,
         dry_run=args.dry_run,
-        merge_duplicates=not args.no_merge_duplicates
+        merge_duplicates=not args.no_merge_duplicates,
+        stream_tar=args.stream_tar,
+        jobs=args.jobs,
+        mksquashfs_idle_timeout=args.mksquashfs_idle_timeout
     )
+    stream_tar = builder.resolve_stream_tar()
+    
+    logger.info("Configuration:")
+    logger.info(f"  Input directory: {args.input_dir}")
+    logger.info(f"  Output file: {output_path}")
+    logger.info(f"  Compression: {args.compression}")
+    if stream_tar:
+        logger.info("  Mode: tar-stream")
+    else:
+        logger.info(f"  Mode: {'memory-efficient' if args.memory_efficient else 'streaming'}")
+        logger.info(f"  Batch size: {args.batch_size} files / {args.batch_bytes / 1024 / 1024:.0f} MB")
+        if args.jobs > 1 and not args.memory_efficient:
+            logger.info(f"  Parallel jobs: {args.jobs}")
+        if args.mksquashfs_idle_timeout is not None:
+            logger.info(f"  mksquashfs idle timeout: {args.mksquashfs_idle_timeout:.0f} s")
+        if args.temp_dir:
+            logger.info(f"  Temp directory: {args.temp_dir}")
+    logger.info(f"  Merge duplicates: {'disabled' if args.no_merge_duplicates else 'enabled'}")
+    if args.dry_run:
+        logger.info("  DRY RUN MODE - No files will be created")
     
     try:
         builder.build_from_archives(archives, memory_efficient=args.memory_efficient)
@@ -0,0 +1,315 @@
+import gzip
+import io
+import logging
+import os
+import sys
+import tarfile
+import time
+
+import pytest
+
+from tars2squashfs.main import (
+    SquashFSBuilder,
+    _empty_dir,
+    _extract_file_member,
+    _filtered_mode,
+    _filtered_name,
+    _rmtree_at,
+    _stream_pax_headers,
+    _TarStreamWriter,
+    _top_dir,
+    _uncompressed_size,
+    open_tar,
+)
+
+
+def make_archive(path, entries):
+    """Write a tar.gz with (name, data, mode) entries; data None makes a directory"""
+    with tarfile.open(path, 'w:gz', format=tarfile.PAX_FORMAT) as tar:
+        for name, data, mode in entries:
+            info = tarfile.TarInfo(name)
+            info.mode = mode
+            info.uid, info.gid, info.uname, info.gname = 4321, 4321, 'creator', 'creators'
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def stream(builder, archives):
+    """Stream archives into an in-memory tar, return {name: (member, data)}"""
+    buf = io.BytesIO()
+    out_tar = _TarStreamWriter(buf)
+    builder.stream_archives(archives, out_tar)
+    out_tar.close()
+    buf.seek(0)
+    result = {}
+    with tarfile.open(fileobj=buf, mode='r:') as tar:
+        for member in tar:
+            data = tar.extractfile(member).read() if member.isfile() else None
+            result[member.name] = (member, data)
+    return result
+
+
+LONG_NAME = 'data/' + 'x' * 120 + '.txt'
+UNICODE_NAME = 'data/ünïcødé.txt'
+
+
+def test_renamed_top_dir_applies_to_long_and_non_ascii_names(tmp_path):
+    entries = [('data', None, 0o755), (LONG_NAME, b'long', 0o644), (UNICODE_NAME, b'uni', 0o644)]
+    first = make_archive(tmp_path / 'a.tar.gz', entries)
+    second = make_archive(tmp_path / 'b.tar.gz', entries)
+    builder = SquashFSBuilder(tmp_path / 'out.sqfs', merge_duplicates=False)
+
+    result = stream(builder, [first, second])
+
+    assert set(result) == {
+        'data', LONG_NAME, UNICODE_NAME,
+        'data_1', 'data_1' + LONG_NAME[4:], 'data_1' + UNICODE_NAME[4:],
+    }
+    assert result['data_1' + LONG_NAME[4:]][1] == b'long'
+    assert result['data_1' + UNICODE_NAME[4:]][1] == b'uni'
+
+
+def test_dotted_top_dir_entry_is_renamed_with_its_contents(tmp_path):
+    entries = [('v1.0', None, 0o750), ('v1.0/f.txt', b'f', 0o644)]
+    first = make_archive(tmp_path / 'a.tar.gz', entries)
+    second = make_archive(tmp_path / 'b.tar.gz', entries)
+    builder = SquashFSBuilder(tmp_path / 'out.sqfs', merge_duplicates=False)
+
+    result = stream(builder, [first, second])
+
+    assert set(result) == {'v1.0', 'v1.0/f.txt', 'v1.0_1', 'v1.0_1/f.txt'}
+    assert result['v1.0_1'][0].isdir()
+    assert result['v1.0_1'][0].mode == 0o750
+
+
+def test_stream_strips_dot_slash_and_filters_modes(tmp_path):
+    archive = make_archive(tmp_path / 'a.tar.gz', [
+        ('.', None, 0o755),
+        ('./data', None, 0o777),
+        ('./data/run.sh', b'#!/bin/sh\n', 0o4755),
+        ('./data/odd.txt', b'odd', 0o651),
+        ('./data/private.txt', b'secret', 0o400),
+    ])
+    builder = SquashFSBuilder(tmp_path / 'out.sqfs')
+
+    result = stream(builder, [archive])
+
+    assert set(result) == {'data', 'data/run.sh', 'data/odd.txt', 'data/private.txt'}
+    assert result['data'][0].mode == 0o755
+    assert result['data/run.sh'][0].mode == 0o755
+    assert result['data/odd.txt'][0].mode == 0o640
+    assert result['data/private.txt'][0].mode == 0o600
+    assert all(member.type == tarfile.REGTYPE for member, data in result.values() if data is not None)
+    assert {(member.uid, member.gid) for member, data in result.values()} == {(os.getuid(), os.getgid())}
+    assert result['data/odd.txt'][1] == b'odd'
+
+
+def test_stream_pax_headers_drop_regenerated_and_sparse_keys():
+    member = tarfile.TarInfo('data/file')
+    member.pax_headers = {
+        'path': 'old/name', 'size': '42', 'GNU.sparse.map': '0,10', 'GNU.sparse.realsize': '42',
+        'uname': 'creator', 'uid': '4321',
+        'SCHILY.xattr.user.tag': 'kept',
+    }
+
+    assert _stream_pax_headers(member) == {'SCHILY.xattr.user.tag': 'kept'}
+
+
+def test_duplicate_paths_are_written_once_last_archive_wins_when_merging(tmp_path):
+    first = make_archive(tmp_path / 'a.tar.gz', [('data', None, 0o755), ('data/f.txt', b'a', 0o644),
+                                                 ('top.txt', b'a', 0o644)])
+    second = make_archive(tmp_path / 'b.tar.gz', [('data', None, 0o755), ('data/f.txt', b'b', 0o644),
+                                                  ('data/g.txt', b'b', 0o644), ('top.txt', b'b', 0o644)])
+
+    merged = stream(SquashFSBuilder(tmp_path / 'out.sqfs'), [first, second])
+    assert set(merged) == {'data', 'data/f.txt', 'data/g.txt', 'top.txt'}
+    assert merged['data/f.txt'][1] == b'b'
+    assert merged['top.txt'][1] == b'b'
+
+    renamed = stream(SquashFSBuilder(tmp_path / 'out.sqfs', merge_duplicates=False), [first, second])
+    assert set(renamed) == {'data', 'data/f.txt', 'top.txt',
+                            'data_1', 'data_1/f.txt', 'data_1/g.txt', 'top.txt_1'}
+    assert renamed['top.txt'][1] == b'a'
+    assert renamed['top.txt_1'][1] == b'b'
+    assert renamed['data/f.txt'][1] == b'a'
+    assert renamed['data_1/f.txt'][1] == b'b'
+
+
+def test_run_mksquashfs_survives_non_utf8_output(tmp_path):
+    # The idle timeout turns a hang on an undrained pipe into a failure
+    builder = SquashFSBuilder(tmp_path / 'out.sqfs', mksquashfs_idle_timeout=10)
+    script = "import sys; sys.stdout.buffer.write(b'\\xff\\xfe\\n' + b'x' * 2000000 + b'\\ndone\\n')"
+
+    returncode, output = builder.run_mksquashfs([sys.executable, '-c', script])
+
+    assert returncode == 0
+    assert output.startswith('\ufffd\ufffd\n')
+    assert output.endswith('done\n')
+
+
+@pytest.mark.parametrize('keep', [100, 0.06, 0.3, 0.5, 0.87, -10])
+def test_truncated_archive_raises(tmp_path, keep):
+    archive = make_archive(tmp_path / 'a.tar.gz', [(f'data/{i}.txt', b'%d' % i * 50, 0o644) for i in range(2000)])
+    data = archive.read_bytes()
+    archive.write_bytes(data[:keep if isinstance(keep, int) else int(len(data) * keep)])
+
+    with pytest.raises(tarfile.ReadError):
+        with open_tar(archive) as tar:
+            for member in tar:
+                if member.isfile():
+                    tar.extractfile(member).read()
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('/abs/x.txt', 'abs/x.txt'),
+    ('a/../b.txt', 'b.txt'),
+    ('./a/b.txt', 'a/b.txt'),
+])
+def test_filtered_name_follows_data_filter(name, expected):
+    assert _filtered_name(tarfile.TarInfo(name)) == expected
+
+
+@pytest.mark.parametrize('name', ['../x.txt', 'a/../../x.txt', '/../x.txt'])
+def test_filtered_name_rejects_escaping_paths(name):
+    with pytest.raises(tarfile.OutsideDestinationError):
+        _filtered_name(tarfile.TarInfo(name))
+
+
+def test_absolute_names_are_extracted_and_streamed_relative(tmp_path):
+    archive = make_archive(tmp_path / 'a.tar.gz', [('/abs', None, 0o755), ('/abs/x.txt', b'x', 0o644)])
+    builder = SquashFSBuilder(tmp_path / 'out.sqfs')
+
+    assert set(stream(builder, [archive])) == {'abs', 'abs/x.txt'}
+
+    dest = tmp_path / 'dest'
+    with open_tar(archive) as tar:
+        for member in tar:
+            if member.isfile():
+                builder.extract_file_member(tar, member, dest)
+    assert (dest / 'abs' / 'x.txt').read_bytes() == b'x'
+
+
+def test_uncompressed_size_reads_gzip_trailer(tmp_path):
+    archive = make_archive(tmp_path / 'a.tar.gz', [(f'data/{i}.txt', b'x' * 1000, 0o644) for i in range(100)])
+
+    with gzip.open(archive) as f:
+        assert _uncompressed_size(archive) == len(f.read())
+
+
+@pytest.mark.parametrize('mode, is_file, expected', [
+    (0o644, True, 0o644),
+    (0o400, True, 0o600),
+    (0o651, True, 0o640),
+    (0o4777, True, 0o755),
+    (0o777, False, 0o755),
+    (0o700, False, 0o700),
+])
+def test_filtered_mode(mode, is_file, expected):
+    member = tarfile.TarInfo('x')
+    member.mode = mode
+    member.type = tarfile.REGTYPE if is_file else tarfile.DIRTYPE
+    assert _filtered_mode(member) == expected
+
+
+def test_extract_file_member_sets_content_mode_and_mtime(tmp_path):
+    archive = make_archive(tmp_path / 'a.tar.gz', [('data/sub/f.txt', b'content', 0o651)])
+    created_parents = set()
+
+    with open_tar(archive) as tar:
+        for member in tar:
+            dst = _extract_file_member(tar, member, tmp_path / 'dest', created_parents)
+            mtime = member.mtime
+
+    assert dst == tmp_path / 'dest' / 'data' / 'sub' / 'f.txt'
+    assert dst.read_bytes() == b'content'
+    assert dst.stat().st_mode & 0o7777 == 0o640
+    assert dst.stat().st_mtime == mtime
+    assert created_parents == {dst.parent}
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('data/sub/f.txt', 'data'),
+    ('./data/f.txt', 'data'),
+    ('/data/f.txt', 'data'),
+    ('data', 'data'),
+    ('file.txt', None),
+    ('.', None),
+    ('', None),
+])
+def test_top_dir(name, expected):
+    assert _top_dir(name) == expected
+
+
+def make_tree_with_outside_link(tmp_path):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    (outside / 'keep.txt').write_bytes(b'keep')
+    staging = tmp_path / 'staging'
+    (staging / 'a' / 'b').mkdir(parents=True)
+    (staging / 'a' / 'b' / 'f.txt').write_bytes(b'f')
+    (staging / 'top.txt').write_bytes(b't')
+    (staging / 'a' / 'link').symlink_to(outside)
+    return staging, outside
+
+
+def test_empty_dir_keeps_dir_and_does_not_follow_symlinks(tmp_path):
+    staging, outside = make_tree_with_outside_link(tmp_path)
+
+    _empty_dir(staging)
+
+    assert staging.is_dir()
+    assert list(staging.iterdir()) == []
+    assert (outside / 'keep.txt').read_bytes() == b'keep'
+
+
+def test_rmtree_at_removes_nested_tree_relative_to_dir_fd(tmp_path):
+    staging, outside = make_tree_with_outside_link(tmp_path)
+
+    dir_fd = os.open(staging, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        _rmtree_at(dir_fd, 'a')
+    finally:
+        os.close(dir_fd)
+
+    assert sorted(p.name for p in staging.iterdir()) == ['top.txt']
+    assert (outside / 'keep.txt').read_bytes() == b'keep'
+
+
+def test_run_mksquashfs_keeps_only_output_tail(tmp_path):
+    builder = SquashFSBuilder(tmp_path / 'out.sqfs')
+    script = "for i in range(200): print(f'line {i}')"
+
+    returncode, output = builder.run_mksquashfs([sys.executable, '-c', script])
+
+    assert returncode == 0
+    assert output.splitlines() == [f'line {i}' for i in range(136, 200)]
+
+
+def test_run_mksquashfs_kills_silent_process(tmp_path):
+    builder = SquashFSBuilder(tmp_path / 'out.sqfs', mksquashfs_idle_timeout=0.5)
+    start = time.monotonic()
+
+    with pytest.raises(RuntimeError, match='no output'):
+        builder.run_mksquashfs([sys.executable, '-c', 'import time; time.sleep(60)'])
+
+    assert time.monotonic() - start < 10
+
+
+def test_batch_is_flushed_on_byte_budget(tmp_path, caplog):
+    archive = make_archive(tmp_path / 'a.tar.gz', [(f'data/{i}.txt', b'x' * 100, 0o644) for i in range(10)])
+    builder = SquashFSBuilder(tmp_path / 'out.sqfs', batch_size=1000, batch_bytes=250, dry_run=True)
+
+    with caplog.at_level(logging.INFO, logger='tars2squashfs.main'):
+        with open_tar(archive) as tar:
+            for member in tar:
+                builder.process_tar_member(tar, member, tmp_path / 'staging')
+
+    appends = [record.getMessage() for record in caplog.records if 'Would append' in record.getMessage()]
+    assert len(appends) == 3
+    assert all(message.startswith('[DRY RUN] Would append 3 files') for message in appends)
+    assert builder.files_in_batch == 1